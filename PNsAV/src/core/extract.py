@@ -1,29 +1,63 @@
 from pipeline import *
+import json
+import logging
 import os
 from pathlib import Path
 import sys
 
 def main():
 
-    if len(sys.argv) < 2:
+    # stdout carries the results, diagnostics go to stderr and only when PNSAV_DEBUG=1
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.DEBUG if os.environ.get("PNSAV_DEBUG") == "1" else logging.WARNING
+    )
+
+    # texts come as arguments, or one per line on stdin so that a whole corpus shares one process
+    texts = sys.argv[1:]
+    if not texts and not sys.stdin.isatty():
+        texts = [line.strip() for line in sys.stdin if line.strip()]
+
+    if not texts:
         print("Error: No input data provided.")
         sys.exit(1)
         
-    data = sys.argv[1]
+    agent_id = os.environ.get("PNSAV_MODEL", "gpt-5.6-sol") # e.g. the model served at PNSAV_BASE_URL
+    agents = [agent_id, agent_id, agent_id]
 
     pipeline = Pipeline(Path(__file__).resolve().parent.parent / "agents_prompts")
-    atoms, rules, args, logs = pipeline.execute_orchestration(
-        agents=["gpt-5.6-sol", "gpt-5.6-sol", "gpt-5.6-sol"],
-        data=data,
-        schemas=[pipeline.atom_schema, pipeline.rule_schema, pipeline.arg_schema]
-    )
+    schemas = [pipeline.atom_schema, pipeline.rule_schema, pipeline.arg_schema]
+    pipeline.model.warmup(agent_id)
+
+    if len(texts) == 1:
+        results = [pipeline.execute_orchestration(agents=agents, data=texts[0], schemas=schemas)]
+    elif os.environ.get("PNSAV_BATCH_API") == "1":
+        # offline run: one OpenAI Batch API job per agent stage
+        results = pipeline.execute_batch_api(agents=agents, texts=texts, schemas=schemas)
+    else:
+        # many texts: run their agent calls concurrently, one output line per text
+        results = pipeline.execute_batch(agents=agents, texts=texts, schemas=schemas)
+
+    for result in results:
+        try:
+            if isinstance(result, Exception):
+                raise result
+            atoms, rules, args, logs = result
+            attacks = pipeline.generate_attacks(str(rules), str(args))
+            args = json.dumps(json.loads(args), ensure_ascii=False) # the raw response may be pretty-printed over many lines
+        except Exception as e:
+            if len(texts) == 1:
+                raise
+            # one failed text leaves a blank line, the others keep their own line
+            print(f"Error: {e}", file=sys.stderr)
+            print()
+            continue
 
-    attacks = pipeline.generate_attacks(str(rules), str(args))
-    ast_logs=[]
-    for i in logs:
-        ast_logs.append((i.text,i.type))
+        ast_logs=[]
+        for i in logs:
+            ast_logs.append((i.text,i.type))
 
-    print(atoms, rules, args, attacks, str(ast_logs), sep="@")
+        print(atoms, rules, args, attacks, str(ast_logs), sep="@")
 
     #rules=ast.literal_eval(rules)
     #args=json.loads(args)
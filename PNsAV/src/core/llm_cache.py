@@ -0,0 +1,75 @@
+import hashlib
+import json
+import sqlite3
+from pathlib import Path
+import numpy as np
+
+CACHE_DIR = Path.home() / ".cache" / "pnsav"
+CACHE_PATH = CACHE_DIR / "llm_cache.sqlite"
+
+_connection = None
+_semantic_index = {} # namespace -> (normalized embeddings matrix, cached responses)
+
+def _connect():
+    """Open (once per process) the SQLite store that backs the prompt->response cache."""
+    global _connection
+    if _connection is None:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        _connection = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+        _connection.execute("PRAGMA journal_mode=WAL")
+        _connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        _connection.execute("CREATE TABLE IF NOT EXISTS embeddings (namespace TEXT NOT NULL, vector BLOB NOT NULL, value TEXT NOT NULL)")
+        _connection.commit()
+    return _connection
+
+def make_key(base_url, agent_id, system_prompt, data, schema_digest):
+    """Build the cache key of an agent call from everything that determines its output, the server included (None for the OpenAI API)."""
+    payload = json.dumps({"url": base_url, "m": agent_id, "sys": system_prompt, "usr": data, "schema": schema_digest}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def get(key):
+    """Return the cached response for the key, or None on a miss."""
+    row = _connect().execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+def set(key, value):
+    """Store the response for the key, replacing any previous entry."""
+    connection = _connect()
+    connection.execute("INSERT OR REPLACE INTO responses (key, value) VALUES (?, ?)", (key, value))
+    connection.commit()
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+def _load_index(namespace):
+    """Load (once per process) the embeddings cached under the namespace into memory."""
+    if namespace not in _semantic_index:
+        rows = _connect().execute("SELECT vector, value FROM embeddings WHERE namespace = ?", (namespace,)).fetchall()
+        vectors = [np.frombuffer(row[0], dtype=np.float32) for row in rows]
+        _semantic_index[namespace] = (np.vstack(vectors) if vectors else None, [row[1] for row in rows])
+    return _semantic_index[namespace]
+
+def semantic_get(namespace, embedding, threshold=0.92):
+    """Return the cached response whose embedding is the most similar to the given one, if the cosine similarity exceeds the threshold."""
+    matrix, values = _load_index(namespace)
+    if matrix is None:
+        return None
+    sims = matrix @ _normalize(embedding)
+    best = int(np.argmax(sims))
+    if sims[best] > threshold:
+        return values[best]
+    return None
+
+def semantic_set(namespace, embedding, value):
+    """Store the response under the namespace, indexed by the embedding of its input text."""
+    vector = _normalize(embedding)
+    connection = _connect()
+    connection.execute("INSERT INTO embeddings (namespace, vector, value) VALUES (?, ?, ?)", (namespace, vector.tobytes(), value))
+    connection.commit()
+
+    matrix, values = _load_index(namespace)
+    matrix = vector[np.newaxis, :] if matrix is None else np.vstack([matrix, vector])
+    _semantic_index[namespace] = (matrix, values + [value])
@@ -1,34 +1,201 @@
 import os
+import asyncio
+import hashlib
+import importlib.util
+import json
+import logging
+import time
+import httpx
 import openai
+import llm_cache
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+
+EMBEDDING_MODEL = os.environ.get("PNSAV_EMBED_MODEL", "text-embedding-3-small")
+
+# upper bound on the tokens an agent may generate (reasoning included on the OpenAI API),
+# roomy for the framework of a debate but it cuts off a runaway response
+MAX_OUTPUT_TOKENS = int(os.environ.get("PNSAV_MAX_OUTPUT_TOKENS", "8192"))
+
+BATCH_POLL_INTERVAL = float(os.environ.get("PNSAV_BATCH_POLL_INTERVAL", "30")) # seconds between Batch API status checks
+
+log = logging.getLogger(__name__)
+
+_JSON_DECODER = json.JSONDecoder()
+
+@dataclass(slots=True)
+class Log:
+    text: str
+    type: str
+
+@lru_cache(maxsize=None)
+def load_prompt(path):
+    """Read a prompt file once per process; every Model then shares the same string object."""
+    return Path(path).resolve().read_text(encoding="utf-8")
+
+# one pool of keep-alive connections per client, multiplexed over HTTP/2 when the h2 package is installed;
+# the SDK's default http clients keep its own timeout and redirect handling
+_HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=64)
+_HTTP2 = importlib.util.find_spec("h2") is not None
+
+def extract_json(raw_output):
+    """
+    Return the JSON object of an agent's response, without any text a server wraps around it (e.g. markdown fences).
+    The object is delimited in a single pass of the C decoder, starting from the first '{'.
+    """
+    start = raw_output.find("{")
+    if start == -1:
+        return raw_output
+    try:
+        _, end = _JSON_DECODER.raw_decode(raw_output, start)
+    except json.JSONDecodeError:
+        return raw_output # left as is, the pipeline logs it as invalid JSON
+    if start == 0 and end == len(raw_output):
+        return raw_output # strict json_schema responses are the object itself
+    return raw_output[start:end]
+
+class _ObjectScanner:
+    """
+    Follow a JSON text as it streams in and tell when its top-level object is closed,
+    tracking the brace depth outside of strings (and their escapes).
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escape = False
+
+    def feed(self, text):
+        """Consume the next piece of text; returns True once the top-level object is complete."""
+        for c in text:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == "\\":
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+            elif c == '"' and self.started:
+                self.in_string = True
+            elif c == "{":
+                self.depth += 1
+                self.started = True
+            elif c == "}" and self.started:
+                self.depth -= 1
+                if self.depth == 0:
+                    return True
+        return False
+
+class _StreamCollector:
+    """Gather the chunks of a streamed response until its JSON object is complete, with the last finish_reason seen."""
+
+    def __init__(self):
+        self.scanner = _ObjectScanner()
+        self.parts = []
+        self.finish_reason = None
+
+    def feed(self, chunk):
+        """Consume the next chunk; returns True once the JSON object is complete and the rest of the stream can be dropped."""
+        if not chunk.choices:
+            return False
+        self.finish_reason = chunk.choices[0].finish_reason or self.finish_reason
+        content = chunk.choices[0].delta.content
+        if not content:
+            return False
+        self.parts.append(content)
+        return self.scanner.feed(content)
+
+    def result(self):
+        return "".join(self.parts), self.finish_reason
 
 class Model:
 
-    def __init__(self, prompt_path):
+    def __init__(self, prompt_path, temperature=None):
         """
         Initialize the Model class with the specified prompt path.
         
         Parameters:
         - prompt_path: Path to the directory containing prompt files.
+        - temperature: Sampling temperature used for every agent call, PNSAV_TEMPERATURE (default 1) when not given.
+          At 0 the responses are deterministic and are cached on disk.
+          Setting PNSAV_SEMCACHE=1 also replays responses cached for paraphrases of the same text (cosine similarity > 0.92),
+          at temperature 0 on the OpenAI API only.
+        
+        Setting PNSAV_BASE_URL points the agents at any OpenAI-compatible server instead of the OpenAI API, e.g. a local
+        llama.cpp server running a quantized model:
+            llama-server -m qwen2.5-14b-instruct-q4_k_m.gguf --flash-attn -ngl 999 --parallel 8 --ctx-size 8192
+        with PNSAV_BASE_URL=http://localhost:8080/v1.
+        With llama-server, PNSAV_PRETOKENIZE=1 also sends the prompts as token ids to its /completion endpoint:
+        the chat template around the messages, the system prompt included, is tokenized once per process
+        and only the user messages are tokenized per call (PNSAV_STREAM is not used on that path).
         
         The constructor reads the prompt files (atom_prompt.txt, rule_prompt.txt, arg_prompt.txt, attack_prompt.txt)
         and stores their contents in instance variables for later use. It also initializes the OpenAI client for making API calls.
         """
         self.prompt_path = prompt_path
-        self.client = openai.OpenAI()
+        if temperature is None:
+            temperature = float(os.environ.get("PNSAV_TEMPERATURE", "1"))
+        self.temperature = temperature
+        self.num_parallel = int(os.environ.get("PNSAV_NUM_PARALLEL", "8"))
+        self.base_url = os.environ.get("PNSAV_BASE_URL")
+        # only deterministic calls are cached, and the embeddings come from the OpenAI API (local servers rarely serve EMBEDDING_MODEL)
+        self.semantic_cache = os.environ.get("PNSAV_SEMCACHE") == "1" and self.temperature == 0 and not self.base_url
+        self.stream = os.environ.get("PNSAV_STREAM") == "1"
+        self.pretokenize = os.environ.get("PNSAV_PRETOKENIZE") == "1" and bool(self.base_url)
+        self._client_options = {}
+        if self.base_url:
+            # local servers do not check the key
+            self._client_options = {"base_url": self.base_url, "api_key": os.environ.get("OPENAI_API_KEY", "no-key")}
+        http_client = openai.DefaultHttpxClient(http2=_HTTP2, limits=_HTTP_LIMITS)
+        self.client = openai.OpenAI(**self._client_options, http_client=http_client)
+        # llama-server's own endpoints (/tokenize, /completion) live at the root of the server, next to /v1
+        self._server_url = self.base_url.rstrip("/").removesuffix("/v1") if self.base_url else None
+        self._server_client = None
+        if self.pretokenize:
+            self._server_client = httpx.Client(base_url=self._server_url, limits=_HTTP_LIMITS, timeout=openai.DEFAULT_TIMEOUT)
+        # bound to the event loop they are used in, created by open_async for each asyncio.run
+        self.async_client = None
+        self._async_server_client = None
+        self._semaphore = None
+        self._prompt_cache_keys = {}
+        self._response_formats = {}
+        self._template_tokens = {} # (system prompt, number of user messages) -> token ids of the template pieces
 
-        self.ATOM_PROMPT = ""
-        with open(os.path.join(prompt_path, "atom_prompt.txt"), "r", encoding="utf-8") as f:
-            self.ATOM_PROMPT = f.read()
+        self.ATOM_PROMPT = load_prompt(Path(prompt_path) / "atom_prompt.txt")
+        self.RULE_PROMPT = load_prompt(Path(prompt_path) / "rule_prompt.txt")
+        self.ARG_PROMPT = load_prompt(Path(prompt_path) / "arg_prompt.txt")
 
-        self.RULE_PROMPT = ""
-        with open(os.path.join(prompt_path, "rule_prompt.txt"), "r", encoding="utf-8") as f:
-            self.RULE_PROMPT = f.read()
+    def warmup(self, agent_id):
+        """
+        Load the agent's model on a local Ollama server (PNSAV_BASE_URL) before the first real call, through Ollama's
+        native /api/generate (a request without prompt only loads the model). The OpenAI-compatible endpoint the agents
+        use has no keep_alive, so start the server with e.g. OLLAMA_KEEP_ALIVE=1h to keep the model loaded between calls.
+        Other servers, such as llama-server, load their model at startup, and the OpenAI API has no model to load,
+        so nothing is done for them.
+        """
+        if not self.base_url:
+            return
+        response = httpx.post(f"{self._server_url}/api/generate", json={"model": agent_id}, timeout=openai.DEFAULT_TIMEOUT)
+        if response.status_code in (404, 405):
+            return # not an Ollama server
+        response.raise_for_status()
+
+    def embed(self, text):
+        """Return the embedding of the text for the semantic cache, or None when the semantic cache is off."""
+        if not self.semantic_cache:
+            return None
+        return self.client.embeddings.create(model=EMBEDDING_MODEL, input=text).data[0].embedding
 
-        self.ARG_PROMPT = ""
-        with open(os.path.join(prompt_path, "arg_prompt.txt"), "r", encoding="utf-8") as f:
-            self.ARG_PROMPT = f.read()
+    async def embed_async(self, text):
+        """Asynchronous version of embed, between open_async and close_async."""
+        if not self.semantic_cache:
+            return None
+        async with self._semaphore:
+            return (await self.async_client.embeddings.create(model=EMBEDDING_MODEL, input=text)).data[0].embedding
 
-    def run_agent(self, agent_id, data, schema, system_prompt):
+    def run_agent(self, agent_id, data, schema, system_prompt, embedding=None, logs=None):
         """
         Run the specified agent with the provided data and schema.
         
@@ -37,21 +204,231 @@ class Model:
         - data: Input data for the agent.
         - schema: JSON schema for validating the agent's output.
         - system_prompt: System prompt to guide the agent's behavior.
+        - embedding: Embedding of the input text (data[0]) from embed(), computed once and shared by the agents of a text.
+          Without it the semantic cache is skipped.
+        - logs: Log entries of the text, an info entry is added when the response is replayed from a similar text.
         
         Returns:
         - The agent's response as a string, following the specified JSON schema.
         """
 
-        messages = [{"role": "system", "content": system_prompt}]
-    
-        for t in data:
-            messages.append({"role": "user", "content": t})
+        cache_key, namespace = self._cache_keys(agent_id, data, schema, system_prompt, embedding)
+        cached = self._cached(agent_id, cache_key, namespace, embedding, logs)
+        if cached is not None:
+            return cached
 
-        response = self.client.chat.completions.create(
-            model=agent_id,
-            temperature=1,
-            messages=messages,
-            response_format={
+        if self.pretokenize:
+            content, finish_reason = self._complete_tokens(data, schema, system_prompt)
+        elif self.stream:
+            content, finish_reason = self._read_stream(self.client.chat.completions.create(**self._request(agent_id, data, schema, system_prompt), stream=True))
+        else:
+            choice = self.client.chat.completions.create(**self._request(agent_id, data, schema, system_prompt)).choices[0]
+            content, finish_reason = choice.message.content, choice.finish_reason
+        return self._finish(agent_id, content, finish_reason, cache_key, namespace, embedding)
+
+    def open_async(self):
+        """
+        Create the async client and the concurrency limit for the running event loop. Both belong to that loop,
+        so every asyncio.run that calls run_agent_async opens them first and closes them with close_async.
+        """
+        async_http_client = openai.DefaultAsyncHttpxClient(http2=_HTTP2, limits=_HTTP_LIMITS)
+        self.async_client = openai.AsyncOpenAI(**self._client_options, http_client=async_http_client)
+        if self.pretokenize:
+            self._async_server_client = httpx.AsyncClient(base_url=self._server_url, limits=_HTTP_LIMITS, timeout=openai.DEFAULT_TIMEOUT)
+        self._semaphore = asyncio.Semaphore(self.num_parallel)
+
+    async def close_async(self):
+        await self.async_client.close()
+        if self._async_server_client is not None:
+            await self._async_server_client.aclose()
+        self.async_client = None
+        self._async_server_client = None
+        self._semaphore = None
+
+    async def run_agent_async(self, agent_id, data, schema, system_prompt, embedding=None, logs=None):
+        """
+        Asynchronous version of run_agent, used to run the agents of many texts concurrently, between open_async and close_async.
+        At most PNSAV_NUM_PARALLEL (default 8) requests are in flight at once; when serving a local
+        model, keep it in line with the server's parallel slots (OLLAMA_NUM_PARALLEL, llama-server --parallel).
+        
+        Returns:
+        - The agent's response as a string, following the specified JSON schema.
+        """
+
+        if self.async_client is None:
+            raise RuntimeError("Model.open_async() must be called in the running event loop before run_agent_async")
+
+        cache_key, namespace = self._cache_keys(agent_id, data, schema, system_prompt, embedding)
+        cached = self._cached(agent_id, cache_key, namespace, embedding, logs)
+        if cached is not None:
+            return cached
+
+        async with self._semaphore:
+            if self.pretokenize:
+                content, finish_reason = await self._complete_tokens_async(data, schema, system_prompt)
+            elif self.stream:
+                content, finish_reason = await self._read_stream_async(await self.async_client.chat.completions.create(**self._request(agent_id, data, schema, system_prompt), stream=True))
+            else:
+                choice = (await self.async_client.chat.completions.create(**self._request(agent_id, data, schema, system_prompt))).choices[0]
+                content, finish_reason = choice.message.content, choice.finish_reason
+        return self._finish(agent_id, content, finish_reason, cache_key, namespace, embedding)
+
+    def run_agent_batch(self, agent_id, data_list, schema, system_prompt):
+        """
+        Run the agent once per input through the OpenAI Batch API (half the token cost, results within 24 hours).
+        Meant for offline runs over many texts; interactive runs use run_agent.
+        
+        Parameters:
+        - data_list: One agent input (list of user messages, as in run_agent) per request.
+        
+        Returns:
+        - One response string per input, in order, or the exception raised for that request.
+        """
+
+        if self.base_url:
+            raise ValueError("The Batch API (PNSAV_BATCH_API=1) is only available on the OpenAI API, unset PNSAV_BASE_URL")
+
+        results = [None] * len(data_list)
+        pending = {} # custom_id -> (index, cache_key)
+        lines = []
+
+        for i, data in enumerate(data_list):
+            cache_key, _ = self._cache_keys(agent_id, data, schema, system_prompt) # no embedding, only the exact cache
+            results[i] = self._cached(agent_id, cache_key, None, None)
+            if results[i] is not None:
+                continue
+            pending[str(i)] = (i, cache_key)
+            lines.append(json.dumps({
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": self._request(agent_id, data, schema, system_prompt)
+            }))
+
+        if not lines:
+            return results
+
+        batch_file = self.client.files.create(file=("batch.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+        batch = self.client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(BATCH_POLL_INTERVAL)
+            batch = self.client.batches.retrieve(batch.id)
+        if batch.status != "completed":
+            raise RuntimeError(f"Batch {batch.id} ended with status {batch.status}")
+
+        outputs = []
+        if batch.output_file_id:
+            outputs += self.client.files.content(batch.output_file_id).text.splitlines()
+        if batch.error_file_id:
+            outputs += self.client.files.content(batch.error_file_id).text.splitlines()
+
+        for line in outputs:
+            if not line.strip():
+                continue
+            output = json.loads(line)
+            i, cache_key = pending.pop(output["custom_id"])
+            response = output.get("response") or {}
+            if output.get("error") or response.get("status_code") != 200:
+                results[i] = RuntimeError(f"Batch request {output['custom_id']} failed: {output.get('error') or response.get('body')}")
+                continue
+            choice = response["body"]["choices"][0]
+            results[i] = self._finish(agent_id, choice["message"]["content"], choice.get("finish_reason"), cache_key, None, None)
+
+        for i, _ in pending.values():
+            results[i] = RuntimeError(f"Batch {batch.id} returned no result for request {i}")
+
+        return results
+
+    def _truncated(self, agent_id, finish_reason):
+        """Report a response cut off at MAX_OUTPUT_TOKENS; such responses are returned but never cached."""
+        if finish_reason == "length":
+            log.warning("%s stopped at the %d output tokens limit (PNSAV_MAX_OUTPUT_TOKENS), its JSON is truncated", agent_id, MAX_OUTPUT_TOKENS)
+            return True
+        return False
+
+    def _read_stream(self, stream):
+        """
+        Collect a streamed response (PNSAV_STREAM=1) and close the stream as soon as the JSON object is complete,
+        so that a server rambling after the object does not keep decoding tokens nobody reads.
+        Returns the text and the finish_reason of the last chunk (None when the stream was closed at the object's end).
+        """
+        collector = _StreamCollector()
+        try:
+            for chunk in stream:
+                if collector.feed(chunk):
+                    break
+        finally:
+            stream.close()
+        return collector.result()
+
+    async def _read_stream_async(self, stream):
+        """Asynchronous version of _read_stream."""
+        collector = _StreamCollector()
+        try:
+            async for chunk in stream:
+                if collector.feed(chunk):
+                    break
+        finally:
+            await stream.close()
+        return collector.result()
+
+    def _cache_keys(self, agent_id, data, schema, system_prompt, embedding=None):
+        """
+        Return the exact and semantic cache keys of an agent call (None when that cache does not apply).
+        The semantic key needs the embedding of the text, without it only the exact cache is used.
+        """
+        if self.temperature != 0: # only deterministic calls can be replayed from the cache
+            return None, None
+        schema_digest = self._response_format(schema)[1]
+        cache_key = llm_cache.make_key(self.base_url, agent_id, system_prompt, data, schema_digest)
+        namespace = None
+        if self.semantic_cache and embedding is not None:
+            # the text is matched by meaning, everything else it is sent with must be identical
+            namespace = llm_cache.make_key(self.base_url, agent_id, system_prompt, data[1:], schema_digest)
+        return cache_key, namespace
+
+    def _cached(self, agent_id, cache_key, namespace, embedding, logs=None):
+        """Return the cached response of an agent call, looked up in the exact cache first, or None on a miss."""
+        if cache_key is not None:
+            cached = llm_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        if namespace is not None:
+            cached = llm_cache.semantic_get(namespace, embedding)
+            if cached is not None:
+                # the response was extracted from a similar text, its source quotes may not match this one
+                if logs is not None:
+                    logs.append(Log(f"The {agent_id} response was replayed from the cache of a similar text (PNSAV_SEMCACHE=1)", "info"))
+            return cached
+        return None
+
+    def _finish(self, agent_id, content, finish_reason, cache_key, namespace, embedding):
+        """Delimit the JSON object of a fresh response and cache it, unless it was cut off at MAX_OUTPUT_TOKENS."""
+        raw_output = extract_json(content.strip())
+        log.debug("%s raw=%s", agent_id, raw_output)
+        if not self._truncated(agent_id, finish_reason):
+            self._cache_store(cache_key, namespace, embedding, raw_output)
+        return raw_output
+
+    def _cache_store(self, cache_key, namespace, embedding, raw_output):
+        if cache_key is not None:
+            llm_cache.set(cache_key, raw_output)
+        if namespace is not None:
+            llm_cache.semantic_set(namespace, embedding, raw_output)
+
+    def _prompt_cache_key(self, system_prompt):
+        if system_prompt not in self._prompt_cache_keys:
+            self._prompt_cache_keys[system_prompt] = "pnsav-" + hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:16]
+        return self._prompt_cache_keys[system_prompt]
+
+    def _response_format(self, schema):
+        """
+        Return the strict response_format of an agent's schema and the digest of the schema used in cache keys.
+        Both are built once per schema object (the module-level schemas of schema.py) and reused by every call.
+        """
+        entry = self._response_formats.get(id(schema))
+        if entry is None or entry[0] is not schema:
+            response_format = {
                 "type": "json_schema",
                 "json_schema": {
                     "name": "argument_framework",
@@ -59,6 +436,96 @@ class Model:
                     "schema": schema
                 }
             }
+            digest = hashlib.sha256(json.dumps(schema, sort_keys=True).encode("utf-8")).hexdigest()
+            entry = (schema, response_format, digest)
+            self._response_formats[id(schema)] = entry
+        return entry[1], entry[2]
+
+    def _request(self, agent_id, data, schema, system_prompt):
+        """
+        Build the chat completion parameters of an agent call.
+        The system prompt always comes first and is sent byte-identical, so the provider's prompt cache
+        reuses its prefill; prompt_cache_key routes the calls of the same agent to the same cache.
+        """
+        messages = [{"role": "system", "content": system_prompt}]
+    
+        for t in data:
+            messages.append({"role": "user", "content": t})
+
+        request = dict(
+            model=agent_id,
+            temperature=self.temperature,
+            messages=messages,
+            response_format=self._response_format(schema)[0]
         )
+        if self.base_url:
+            request["max_tokens"] = MAX_OUTPUT_TOKENS
+        else: # prompt_cache_key is specific to the OpenAI API
+            request["prompt_cache_key"] = self._prompt_cache_key(system_prompt)
+            request["max_completion_tokens"] = MAX_OUTPUT_TOKENS
+        return request
+
+    def _complete_tokens(self, data, schema, system_prompt):
+        """Run an agent call on llama-server's /completion endpoint with a pre-tokenized prompt (PNSAV_PRETOKENIZE=1)."""
+        steps = self._token_completion(data, schema, system_prompt)
+        try:
+            endpoint, body = next(steps)
+            while True:
+                response = self._server_client.post(endpoint, json=body)
+                response.raise_for_status()
+                endpoint, body = steps.send(response.json())
+        except StopIteration as done:
+            return done.value
+
+    async def _complete_tokens_async(self, data, schema, system_prompt):
+        """Asynchronous version of _complete_tokens."""
+        steps = self._token_completion(data, schema, system_prompt)
+        try:
+            endpoint, body = next(steps)
+            while True:
+                response = await self._async_server_client.post(endpoint, json=body)
+                response.raise_for_status()
+                endpoint, body = steps.send(response.json())
+        except StopIteration as done:
+            return done.value
+
+    def _token_completion(self, data, schema, system_prompt):
+        """
+        The llama-server calls of an agent call on a pre-tokenized prompt, shared by the sync and async paths:
+        every call is yielded as (endpoint, body) and the driver sends back the decoded response.
+        The server's chat template is rendered once per system prompt and number of user messages, with placeholders
+        in place of the messages, and its pieces around them are tokenized once; a call then only tokenizes its own
+        user messages (without special tokens, as the chat endpoint does) and sends the whole prompt as token ids.
+        Returns the text and the finish_reason of the completion.
+        """
+        key = (system_prompt, len(data))
+        pieces = self._template_tokens.get(key)
+        if pieces is None:
+            placeholders = [f"<pnsav-message-{i}>" for i in range(len(data))]
+            messages = [{"role": "system", "content": system_prompt}]
+            messages += [{"role": "user", "content": p} for p in placeholders]
+            template = (yield "/apply-template", {"messages": messages})["prompt"]
+            texts = []
+            for p in placeholders:
+                text, template = template.split(p, 1)
+                texts.append(text)
+            texts.append(template) # the end of the last message and the assistant header
+            pieces = []
+            for i, text in enumerate(texts):
+                pieces.append((yield "/tokenize", {"content": text, "add_special": i == 0, "parse_special": True})["tokens"])
+            self._template_tokens[key] = pieces
+
+        tokens = list(pieces[0])
+        for text, piece in zip(data, pieces[1:]):
+            tokens += (yield "/tokenize", {"content": text, "add_special": False, "parse_special": False})["tokens"]
+            tokens += piece
 
-        return response.choices[0].message.content.strip()
\ No newline at end of file
+        output = yield "/completion", {
+            "prompt": tokens,
+            "temperature": self.temperature,
+            "n_predict": MAX_OUTPUT_TOKENS,
+            "json_schema": schema,
+            "cache_prompt": True
+        }
+        finish_reason = "length" if output.get("stop_type") == "limit" or output.get("stopped_limit") else "stop"
+        return output["content"], finish_reason
\ No newline at end of file
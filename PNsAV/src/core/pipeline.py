@@ -1,20 +1,22 @@
 import json
 import ast
-from model import Model
+import asyncio
+from model import Log, Model
 from schema import atom_schema, argument_schema, rule_schema
 import symbolic_data_repair.atom as atom
 import symbolic_data_repair.arg as arg
 import symbolic_data_repair.rule as rule
 import time
 
-class Log:
-    def __init__(self, text, type):
-        self.text = text
-        self.type = type
+try:
+    import orjson # optional, decodes the agents' responses several times faster than json
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
 
 class Pipeline:
-    def __init__(self, prompt_path):
-        self.model = Model(prompt_path)
+    def __init__(self, prompt_path, temperature=None):
+        self.model = Model(prompt_path, temperature)
         self.logs = []
         self.atom_schema = atom_schema
         self.rule_schema = rule_schema
@@ -22,49 +24,203 @@ class Pipeline:
     
     def execute_orchestration(self, agents, data, schemas):
         start = time.perf_counter()
+        embedding = self.model.embed(data)
+        steps = self._orchestration(agents, data, schemas, self.logs, start)
+        try:
+            call = next(steps)
+            while True:
+                call = steps.send(self.model.run_agent(**call, embedding=embedding, logs=self.logs))
+        except StopIteration as done:
+            return done.value
 
-        atoms = self.model.run_agent(
+    def execute_batch(self, agents, texts, schemas):
+        """
+        Run the orchestration for every text, with the agent calls of different texts in flight concurrently.
+        Returns one (atoms, rules, args, logs) tuple, or the raised exception, per text, in input order.
+        """
+        async def gather():
+            self.model.open_async() # the async client and semaphore of this event loop
+            try:
+                tasks = [self._execute_orchestration_async(agents, data, schemas) for data in texts]
+                return await asyncio.gather(*tasks, return_exceptions=True)
+            finally:
+                await self.model.close_async()
+
+        return asyncio.run(gather())
+
+    def execute_batch_api(self, agents, texts, schemas):
+        """
+        Run the orchestration for every text through the OpenAI Batch API, one batch per agent stage.
+        Returns one (atoms, rules, args, logs) tuple, or the exception that stopped that text, per text, in input order.
+        """
+        start = time.perf_counter()
+        results = [None] * len(texts)
+        logs = [[] for _ in texts]
+
+        atoms = self.model.run_agent_batch(
             agent_id=agents[0],
-            data=[data],
+            data_list=[[data] for data in texts],
             schema=schemas[0],
             system_prompt=self.model.ATOM_PROMPT
         )
+        alive = self._drop_failed(atoms, results)
+        for i in alive:
+            try:
+                atoms[i] = self._repair_atoms(atoms[i], texts[i], logs[i])
+            except Exception as e:
+                results[i] = e # only this text stops, the others go on
+        alive = [i for i in alive if results[i] is None]
 
-        atom_status, atom_logs = atom.validate_atoms(atoms, data)
-        for i in atom_logs:
-            log = Log(i[0], i[1])
-            self.logs.append(log)
-        atoms = atom.remove_duplicate_atoms(atoms)
+        rules = self._run_stage_batch(agents[1], [[texts[i], str(atoms[i])] for i in alive], schemas[1], self.model.RULE_PROMPT, alive, len(texts))
+        alive = self._drop_failed(rules, results)
+        for i in alive:
+            try:
+                rules[i] = self._repair_rules(rules[i], logs[i])
+            except Exception as e:
+                results[i] = e
+        alive = [i for i in alive if results[i] is None]
+
+        agent_alive = [i for i in alive if self._needs_arg_agent(atoms[i], rules[i])]
+        args = self._run_stage_batch(agents[2], [[texts[i], str(atoms[i]), str(rules[i])] for i in agent_alive], schemas[2], self.model.ARG_PROMPT, agent_alive, len(texts))
+        for i in alive:
+            if i not in agent_alive:
+                try:
+                    args[i] = self._atomic_arguments(atoms[i], logs[i])
+                except Exception as e:
+                    args[i] = e # dropped with the failed requests below
+        alive = self._drop_failed(args, results)
+        for i in alive:
+            try:
+                self._validate_args(args[i], rules[i], logs[i])
+            except Exception as e:
+                results[i] = e
+                continue
+            logs[i].append(Log(f"Text extraction and validation took: {time.perf_counter()-start:.4f} seconds", "info"))
+            results[i] = (atoms[i], rules[i], args[i], logs[i])
+
+        return results
+
+    def _run_stage_batch(self, agent_id, data_list, schema, system_prompt, alive, size):
+        """Run one agent stage for the texts still alive, scattering the responses back to their text index."""
+        outputs = [None] * size
+        if alive:
+            for i, output in zip(alive, self.model.run_agent_batch(agent_id, data_list, schema, system_prompt)):
+                outputs[i] = output
+        return outputs
+
+    def _drop_failed(self, outputs, results):
+        """Record the failed requests of a stage in results and return the indices of the texts that go on."""
+        alive = []
+        for i, output in enumerate(outputs):
+            if isinstance(output, Exception):
+                results[i] = output
+            elif output is not None and results[i] is None:
+                alive.append(i)
+        return alive
+
+    async def _execute_orchestration_async(self, agents, data, schemas):
+        """Asynchronous version of execute_orchestration, its agent calls share the event loop with the other texts'."""
+        start = time.perf_counter()
+        logs = []
+        embedding = await self.model.embed_async(data)
+        steps = self._orchestration(agents, data, schemas, logs, start)
+        try:
+            call = next(steps)
+            while True:
+                call = steps.send(await self.model.run_agent_async(**call, embedding=embedding, logs=logs))
+        except StopIteration as done:
+            return done.value
+
+    def _orchestration(self, agents, data, schemas, logs, start):
+        """
+        The agents and symbolic repairs of one text, shared by execute_orchestration and its async version:
+        every agent call is yielded as the keyword arguments of run_agent, and the driver sends back the response.
+        """
+        atoms = yield dict(
+            agent_id=agents[0],
+            data=[data],
+            schema=schemas[0],
+            system_prompt=self.model.ATOM_PROMPT
+        )
+        atoms = self._repair_atoms(atoms, data, logs)
 
-        rules = self.model.run_agent(
+        rules = yield dict(
             agent_id=agents[1],
             data=[data,str(atoms)],
             schema=schemas[1],
             system_prompt=self.model.RULE_PROMPT
         )
+        rules = self._repair_rules(rules, logs)
+
+        if self._needs_arg_agent(atoms, rules):
+            args = yield dict(
+                agent_id=agents[2],
+                data=[data,str(atoms),str(rules)],
+                schema=schemas[2],
+                system_prompt=self.model.ARG_PROMPT
+            )
+        else:
+            args = self._atomic_arguments(atoms, logs)
+        self._validate_args(args, rules, logs)
+
+        logs.append(Log(f"Text extraction and validation took: {time.perf_counter()-start:.4f} seconds", "info"))
+
+        return atoms, rules, args, logs
+
+    def _decode(self, raw_output):
+        """Decode an agent's response once, so its validation and repair passes share the same dict."""
+        try:
+            return _loads(raw_output)
+        except json.JSONDecodeError: # orjson.JSONDecodeError is a subclass
+            return raw_output # left as is, the validators log it as invalid JSON and the repairs are skipped
 
+    def _repair_atoms(self, atoms, data, logs):
+        atoms = self._decode(atoms)
+        atom_status, atom_logs = atom.validate_atoms(atoms, data)
+        for i in atom_logs:
+            log = Log(i[0], i[1])
+            logs.append(log)
+        if not isinstance(atoms, dict):
+            return atoms # invalid JSON, nothing to repair
+        return atom.remove_duplicate_atoms(atoms)
+
+    def _repair_rules(self, rules, logs):
+        rules = self._decode(rules)
         rules_status, rules_logs = rule.validate_rules(rules)
         for i in rules_logs:
             log = Log(i[0], i[1])
-            self.logs.append(log)
+            logs.append(log)
+        if not isinstance(rules, dict):
+            return rules # invalid JSON, nothing to repair
         rules = rule.remove_identity(rules)
-        rules = rule.remove_duplicate_rules(str(rules))
+        return rule.remove_duplicate_rules(rules)
 
-        args = self.model.run_agent(
-            agent_id=agents[2],
-            data=[data,str(atoms),str(rules)],
-            schema=schemas[2],
-            system_prompt=self.model.ARG_PROMPT
-        )
+    def _needs_arg_agent(self, atoms, rules):
+        """Without any rule every argument is atomic, so the argument agent only has to run when rules were extracted."""
+        if not isinstance(atoms, dict) or not isinstance(rules, dict):
+            return True # invalid JSON upstream, let the agent and the validators deal with it
+        return bool(rules.get("rules"))
+
+    def _atomic_arguments(self, atoms, logs):
+        """Build the argument agent's output symbolically: one atomic argument per atom, in the argument schema."""
+        arguments = [
+            {"id": f"A{i}", "conclusion": a["id"], "top_rule": None, "sub_arguments": [], "type": "atomic"}
+            for i, a in enumerate(atoms["atoms"], start=1)
+        ]
+        logs.append(Log("No rules were extracted, the arguments were built without the argument agent", "info"))
+        return json.dumps({
+            "scratchpad": {
+                "text_connectors_found": [],
+                "rule_firing_verification": "No rules were extracted, every atom is an atomic argument."
+            },
+            "arguments": arguments
+        })
 
-        args_status, args_logs = arg.validate_arguments(args, rules)
+    def _validate_args(self, args, rules, logs):
+        args_status, args_logs = arg.validate_arguments(self._decode(args), rules)
         for i in args_logs:
             log = Log(i[0], i[1])
-            self.logs.append(log)
-
-        self.logs.append(Log(f"Text extraction and validation took: {time.perf_counter()-start:.4f} seconds", "info"))
-
-        return atoms, rules, args, self.logs
+            logs.append(log)
 
     def generate_attacks(self, rules, args):
         rules = ast.literal_eval(rules)
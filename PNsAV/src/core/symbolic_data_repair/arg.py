@@ -2,6 +2,10 @@
 # verify data types
 
 import json
+from .utils import decode
+
+ARGUMENT_KEYS = frozenset(["id", "conclusion", "top_rule", "sub_arguments", "type"])
+ARGUMENT_TYPES = frozenset(["atomic", "defeasible", "strict"])
 
 #"arguments":[{"id":"A1","conclusion":"a1","top_rule":null,"sub_arguments":[],"type":"atomic"}
 
@@ -17,78 +21,94 @@ def verify_arg_id(arg_id):
 
 def verify_type(arg_type):
     """Check if the argument type is valid (one of 'atomic', 'defeasible', 'strict')."""
-    return arg_type in ["atomic", "defeasible", "strict"] # check if arg_type is one of the valid types
-
-def verify_conclusion_match(arg,rules):
-    """Check if the argument's conclusion matches the conclusion of its top rule."""
+    return arg_type in ARGUMENT_TYPES # check if arg_type is one of the valid types
 
-    if type(rules) == str:
+def index_rules(rules):
+    """
+    Return the ID -> rule index of the rules, given as the rule agent's output (JSON string or decoded dict)
+    or as a list of rules; the first rule wins for a repeated ID. Returns None if the JSON is invalid.
+    """
+    if isinstance(rules, str):
         try:
             rules = json.loads(rules)
         except json.JSONDecodeError:
+            return None # LLM returned invalid JSON for rules
+    if isinstance(rules, dict):
+        rules = rules.get("rules", []) # the rule agent's output
+    rules_index = {}
+    for r in rules:
+        if type(r) != str:
+            rules_index.setdefault(r.get("id"), r)
+    return rules_index
+
+def verify_conclusion_match(arg, rules, rules_index=None):
+    """Check if the argument's conclusion matches the conclusion of its top rule (rules_index: index_rules(rules), if already built)."""
+
+    if rules_index is None:
+        rules_index = index_rules(rules)
+        if rules_index is None:
             return False, ["Invalid JSON format for rules"] # LLM returned invalid JSON for rules
         
     top_rule_id = arg.get("top_rule")
     if top_rule_id is None:
         return True # no top rule to check
-    for r in rules:
-        if type(r) != str:
-            if r.get("id") == top_rule_id:
-                return r.get("conclusion") == arg.get("conclusion") # check if conclusions match
-    return False # top rule not found
+    r = rules_index.get(top_rule_id)
+    if r is None:
+        return False # top rule not found
+    return r.get("conclusion") == arg.get("conclusion") # check if conclusions match
 
-def verify_sub_arguments(arg, rules, arguments_map):
-    """Check if the conclusions of the sub-argument IDs match the premises of the top rule."""
+def verify_sub_arguments(arg, rules, arguments_map, rules_index=None):
+    """Check if the conclusions of the sub-argument IDs match the premises of the top rule (rules_index: index_rules(rules), if already built)."""
 
-    if type(rules) == str:
-        try:
-            rules = json.loads(rules)
-        except json.JSONDecodeError:
+    if rules_index is None:
+        rules_index = index_rules(rules)
+        if rules_index is None:
             return False, ["Invalid JSON format for rules"] # LLM returned invalid JSON for rules
 
     top_rule_id = arg.get("top_rule")
     if top_rule_id is None or top_rule_id == "null":
         return True 
         
-    for r in rules:
-        if type(r) != str:
-            if r.get("id") == top_rule_id:
-                premises = r.get("premises", [])
-                sub_arg_ids = arg.get("sub_arguments", [])
-                
-                if len(premises) != len(sub_arg_ids):
-                    return False
-                    
-                for sub_arg_id, premise in zip(sub_arg_ids, premises):
-                    sub_arg = arguments_map.get(sub_arg_id)
-                    if not sub_arg:
-                        return False
-                        
-                    if sub_arg.get("conclusion") != premise:
-                        return False 
-                return True
+    r = rules_index.get(top_rule_id)
+    if r is None:
+        return False
+
+    premises = r.get("premises", [])
+    sub_arg_ids = arg.get("sub_arguments", [])
+    
+    if len(premises) != len(sub_arg_ids):
+        return False
+        
+    for sub_arg_id, premise in zip(sub_arg_ids, premises):
+        sub_arg = arguments_map.get(sub_arg_id)
+        if not sub_arg:
+            return False
             
-    return False
+        if sub_arg.get("conclusion") != premise:
+            return False 
+    return True
 
 def validate_arguments(json_string, rules):
-    """Validate the structure and types of the arguments JSON. Returns True if valid, False otherwise."""
-    try:
-        inp = json.loads(json_string)
-    except json.JSONDecodeError:
+    """Validate the structure and types of the arguments JSON (or its already decoded dict). Returns True if valid, False otherwise."""
+    inp = decode(json_string)
+    if inp is None:
         return False, [("Invalid JSON format", "error")] # LLM returned invalid JSON
+
+    rules_index = index_rules(rules) # built once for every argument
     
     logs = []
+    arguments_map = {a.get("id"): a for a in inp["arguments"]}
         
     for arg in inp["arguments"]:
-        if set(["id","conclusion","top_rule","sub_arguments","type"]) != set(arg.keys()):
+        if arg.keys() != ARGUMENT_KEYS:
             logs.append(("Required keys missing for argument: {}".format(arg.get("id", "Unknown")), "error"))
         if not verify_arg_id(arg["id"]):
             logs.append(("Invalid argument ID: {}".format(arg["id"]), "error"))
         if not verify_type(arg["type"]):
             logs.append(("Invalid argument type for argument {}: {}".format(arg["id"], arg["type"]), "error"))
-        if not verify_conclusion_match(arg, rules):
+        if not verify_conclusion_match(arg, rules, rules_index):
             logs.append(("Conclusion does not match the top rule for argument {}: {}".format(arg["id"], arg["conclusion"]), "warning"))
-        if not verify_sub_arguments(arg, rules, inp["arguments"]):
+        if not verify_sub_arguments(arg, rules, arguments_map, rules_index):
             logs.append(("Sub-arguments are invalid for argument {}: {}".format(arg["id"], arg["sub_arguments"]), "warning"))
     if logs:
         return False, logs
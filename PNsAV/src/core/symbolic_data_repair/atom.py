@@ -1,4 +1,7 @@
-import json
+from .utils import decode
+
+ATOM_KEYS = frozenset(["id", "text", "kb_type", "source_quote"])
+KB_TYPES = frozenset(["axiom", "premise"])
 
 def verify_source_quotes(source_quote, source):
     """Check if the source quote is present in the source text."""
@@ -14,18 +17,18 @@ def verify_atom_id(atom_id):
 
 def verify_kb_type(kb_type):
     """Check if the kb_type is valid (one of 'axiom', 'premise')."""
-    return kb_type in ["axiom", "premise"] # check if kb_type is one of the valid types
+    return kb_type in KB_TYPES # check if kb_type is one of the valid types
 
 def validate_atoms(json_string, source):
-    try:
-        inp = json.loads(json_string)
-    except json.JSONDecodeError:
-        return False, "Invalid JSON format" # LLM returned invalid JSON
+    """Validate the atoms, given either as the agent's JSON string or as its already decoded dict."""
+    inp = decode(json_string)
+    if inp is None:
+        return False, [("Invalid JSON format", "error")] # LLM returned invalid JSON
     
     logs = []
     
     for atom in inp["atoms"]: # id, text, kb_type, source_quote
-        if set(["id","text","kb_type","source_quote"]) != set(atom.keys()):
+        if atom.keys() != ATOM_KEYS:
             logs.append(("Required keys missing for atom: {}".format(atom.get("id", "Unknown")), "error"))
         if not verify_atom_id(atom["id"]):
             logs.append(("Invalid atom ID: {}".format(atom["id"]), "error"))
@@ -39,10 +42,9 @@ def validate_atoms(json_string, source):
     return True, [("Correct parsing of the atoms", "valid")] # all checks passed
 
 def remove_duplicate_atoms(json_string):
-    """Remove duplicate atoms from the JSON string."""
-    try:
-        inp = json.loads(json_string)
-    except json.JSONDecodeError:
+    """Remove duplicate atoms from the JSON string (or its already decoded dict)."""
+    inp = decode(json_string)
+    if inp is None:
         return json_string # LLM returned invalid JSON
         
     seen = set()
@@ -1,8 +1,10 @@
-import json
+from .utils import decode
+
+RULE_TYPES = frozenset(["strict", "defeasible"])
 
 def verify_type(type):
     """Check if the type is valid (one of 'strict', 'defeasible')."""
-    return type in ["strict", "defeasible"] # check if type is one of the valid types
+    return type in RULE_TYPES # check if type is one of the valid types
 
 def verify_rule_id(rule_id):
     """Check if the rule ID is valid (starts with 'r' followed by digits)."""
@@ -13,11 +15,10 @@ def verify_rule_id(rule_id):
     return True
 
 def validate_rules(json_string):
-    """Validate the structure and types of the rules JSON. Returns True if valid, False otherwise.."""
-    try:
-        inp = json.loads(json_string)
-    except json.JSONDecodeError:
-        return False, "Invalid JSON format" # LLM returned invalid JSON
+    """Validate the structure and types of the rules JSON (or its already decoded dict). Returns True if valid, False otherwise.."""
+    inp = decode(json_string)
+    if inp is None:
+        return False, [("Invalid JSON format", "error")] # LLM returned invalid JSON
     
     logs = []
 
@@ -37,11 +38,10 @@ def validate_rules(json_string):
     return True, [("Correct parsing of the rules","valid")] # all checks passed
 
 def remove_identity(json_string):
-    """Remove identity rules from the JSON string."""
+    """Remove identity rules from the JSON string (or its already decoded dict)."""
     # identity rule is when the premise is identical to the conclusion
-    try:
-        inp = json.loads(json_string)
-    except json.JSONDecodeError:
+    inp = decode(json_string)
+    if inp is None:
         return json_string # LLM returned invalid JSON
         
     inp["rules"] = [
@@ -52,10 +52,9 @@ def remove_identity(json_string):
     return inp
 
 def remove_duplicate_rules(json_string):
-    """Remove duplicate rules from the JSON string."""
-    try:
-        inp = json.loads(json_string)
-    except json.JSONDecodeError:
+    """Remove duplicate rules from the JSON string (or its already decoded dict)."""
+    inp = decode(json_string)
+    if inp is None:
         return json_string # LLM returned invalid JSON
         
     seen = set()
@@ -0,0 +1,10 @@
+import json
+
+def decode(json_string):
+    """Return the decoded dict of the agent's JSON string (dicts already decoded by the pipeline are returned as is), or None if the JSON is invalid."""
+    if isinstance(json_string, dict):
+        return json_string
+    try:
+        return json.loads(json_string)
+    except json.JSONDecodeError:
+        return None
@@ -12,12 +12,15 @@ from datetime import datetime
 import colorsys
 import random
 import html as html_lib
+import logging
 import re
 
 BASE_DIR = Path(__file__).resolve().parent
 STYLE_PATH = BASE_DIR / "style.css"
 LOGO_PATH = BASE_DIR / "pnsav_logo.PNG"
 
+logger = logging.getLogger(__name__)
+
 def highlight_text(text, quote_to_color):
     """
     text: the raw analyzed text
@@ -56,9 +59,10 @@ def highlight_text(text, quote_to_color):
         )
         cursor = end
     pieces.append(html_lib.escape(text[cursor:]))
-    print("".join(pieces))
+    highlighted_text = "".join(pieces)
+    logger.debug("highlighted=%s", highlighted_text)
 
-    return "".join(pieces)
+    return highlighted_text
 
 def random_nice_color_dark_theme():
     h = random.random()
@@ -190,7 +194,7 @@ with col_stanga:
                     st.session_state["rules"] = ast.literal_eval(extracted.split("@")[1])["rules"]
                     st.session_state["args"] = json.loads(extracted.split("@")[2])["arguments"]
                     st.session_state["attacks"] = ast.literal_eval(extracted.split("@")[3])
-                    print(ast.literal_eval(extracted.split("@")[3]))
+                    logger.debug("attacks=%s", st.session_state["attacks"])
                     st.session_state["logs"] = ast.literal_eval(extracted.split("@")[4])
                 except subprocess.CalledProcessError as e:
                     st.error(f"❌ Script `extract.py` returned {e.returncode}")
@@ -306,7 +310,7 @@ with col_dreapta:
         for arg in arguments:
             if arg:
                 info = arg.split("|")
-                print(info)
+                logger.debug("argument=%s", info)
 
                 color = random_nice_color_dark_theme() if info[1] == "atomic" else "#FF5733"
                 if info[1]=="atomic":